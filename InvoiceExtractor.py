@@ -6,49 +6,181 @@ stores structured data in a MongoDB database.The system supports duplicate detec
 """ 
 
 import os
+import binascii
 import imaplib
+import hashlib
+import ssl
 import email
+import email.parser
+import email.policy
 import pdf2image
+import pdfminer.high_level
 import pytesseract
 import pymongo
+import pandas as pd
 import re
 import json
-from email.header import decode_header
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+# Run Tesseract single-threaded; parallelism comes from running several OCR processes at once
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Prefer the linear-time RE2 engine (google-re2) when installed; fall back to the standard library otherwise
+try:
+    import re2 as regex_engine
+except ImportError:
+    regex_engine = re
+
+# PDFs with at least this much embedded text skip OCR entirely
+MIN_PDF_TEXT_LAYER_CHARS = 50
+
+# Images are downscaled to fit A4 at 300 DPI and binarized at this grayscale threshold before OCR
+MAX_OCR_IMAGE_SIDE = 3508
+OCR_BINARIZE_THRESHOLD = 160
+
+# Number of pdftoppm threads used to rasterize the pages of a PDF
+PDF_RASTER_THREADS = 4
+
+# Prefer a persistent in-process Tesseract API (tesserocr) when installed; fall back to pytesseract otherwise.
+# Each OCR worker process loads its own API, since sharing one across threads serializes the calls.
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+_TESS_API = None
+
+# UID of each message within a batched IMAP FETCH response
+FETCH_UID_RE = re.compile(rb"UID (\d+)")
+
+# Number of emails fetched per UID FETCH command
+FETCH_BATCH_SIZE = 50
+
+# Size of the chunks (in characters) a base64 attachment payload is decoded in
+BASE64_DECODE_CHUNK_SIZE = 64 * 1024
+
+# Size of the chunks a fetched email is fed to the MIME parser in
+EMAIL_PARSE_CHUNK_SIZE = 64 * 1024
+
+# Single precompiled pattern for invoice data extraction; each field is a named alternative.
+# It is matched against upper-cased text, so it needs no case-insensitive flag.
+INVOICE_FIELDS_RE = regex_engine.compile(
+    r"(?P<invoice_number>[A-Z]{3,5}\d{6,8})"
+    r"|€\s?(?P<amount>[\d,]+\.\d{2})"
+    r"|DUE DATE[:\s]*(?P<due_date>\d{2}/\d{2}/\d{4})"
+    r"|(?P<payment_status>\bPAID\b)"
+)
+
+# IMAP server addresses of the supported email providers; any other input is used as the server address itself
+IMAP_SERVERS = {
+    "gmail": "imap.gmail.com",
+    "outlook": "outlook.office365.com",
+    "yahoo": "imap.mail.yahoo.com",
+}
+
+# Emails smaller than this (in bytes) are skipped by the server-side search, as they are too small to carry an invoice attachment
+MIN_INVOICE_EMAIL_SIZE = 20000
+
+# Gmail's IMAP extension capability and its search filter for emails with attachments
+GMAIL_CAPABILITY = "X-GM-EXT-1"
+GMAIL_HAS_ATTACHMENT_FILTER = 'X-GM-RAW "has:attachment"'
+
+# Fields identifying a duplicate invoice and a recurring (same sender and amount) invoice
+DEDUP_KEY_FIELDS = ["email_uid", "sender", "invoice_number"]
+RECURRING_KEY_FIELDS = ["sender", "amount"]
+
+# Invoices are stored with the email's IMAP UID and tagged with this marker. Older records hold the mailbox
+# sequence number instead and have no marker, so they are matched as duplicates on these fields instead.
+EMAIL_UID_TYPE = "uid"
+LEGACY_DEDUP_KEY_FIELDS = ["sender", "invoice_number"]
+
+# Process-lifetime connections, reused across calls instead of reconnecting each time
+_MONGO_CLIENT = None
+_IMAP_POOL = {}  # (imap_server, email_user, password hash) -> imaplib.IMAP4_SSL
+
+# Normalizing records stored by older versions
+def normalize_unknown_fields(collection):
+    """Replaces the "Unknown" placeholder stored by older versions with None, so old and new records share one key format."""
+    for field in ("invoice_number", "amount", "due_date"):
+        try:
+            collection.update_many({field: "Unknown"}, {"$set": {field: None}})
+        except pymongo.errors.OperationFailure as e:
+            # A record with the same key already stores None, so the unique index rejects the update
+            print(f"Warning: Unable to normalize unknown {field} values:", e)
+
+# Creating indexes for duplicate and recurring invoice lookups
+def create_indexes(collection):
+    """Creates the compound indexes used for duplicate detection and recurring invoice classification."""
+    try:
+        collection.create_index([(field, pymongo.ASCENDING) for field in DEDUP_KEY_FIELDS], unique=True)
+    except pymongo.errors.OperationFailure as e:
+        # Existing duplicate documents prevent a unique index; fall back to a plain one for lookups
+        print("Warning: Unable to create unique invoice index:", e)
+        collection.create_index([(field, pymongo.ASCENDING) for field in DEDUP_KEY_FIELDS])
+    # Invoices with an unknown (None) amount are never recurring, so they are kept out of the recurring index
+    recurring_index = [(field, pymongo.ASCENDING) for field in RECURRING_KEY_FIELDS]
+    known_amount_filter = {"amount": {"$gt": ""}}  # Matches string amounts only, excluding None
+    try:
+        collection.create_index(recurring_index, partialFilterExpression=known_amount_filter)
+    except pymongo.errors.OperationFailure:
+        # An older full index with the same name exists; replace it with the partial one
+        collection.drop_index(recurring_index)
+        collection.create_index(recurring_index, partialFilterExpression=known_amount_filter)
 
 # Connection Setup for MongoDB
 def connect_to_mongo():
-    """Connects to MongoDB and returns the collections for invoices and recurring invoices."""
+    """Connects to MongoDB (reusing the pooled client if one exists) and returns the collections for invoices and recurring invoices."""
+    global _MONGO_CLIENT
     try:
-        client = pymongo.MongoClient("mongodb://localhost:27017/", serverSelectionTimeoutMS=5000)
+        client = _MONGO_CLIENT or pymongo.MongoClient("mongodb://localhost:27017/", serverSelectionTimeoutMS=5000, maxPoolSize=16)
         client.server_info()  # Check if MongoDB is reachable
+        _MONGO_CLIENT = client
         db = client["InvoiceDB"]
         collection = db["Invoices"]
         recurring_collection = db["RecurringInvoices"]
+        normalize_unknown_fields(collection)
+        normalize_unknown_fields(recurring_collection)
+        create_indexes(collection)
         return collection, recurring_collection
     except pymongo.errors.ServerSelectionTimeoutError:
         print("Error: Unable to connect to MongoDB. Ensure MongoDB is running.")
         return None, None
 
 # Connecting to the email server
-def connect_to_email(imap_server, email_user, email_pass):
+def connect_to_email(imap_server, email_user, email_pass, provider=None):
     """
     Connects to the email server using the given credentials and selects the inbox.
+    A live connection for the same server, user and password is reused instead of logging in again.
         
     Args:
         imap_server (str): IMAP server address (e.g., imap.gmail.com).
         email_user (str): Email address.
         email_pass (str): Email password.
+        provider (str): Provider name shown on login (e.g., gmail); defaults to the server address.
     
     Returns:
         imaplib.IMAP4_SSL: IMAP connection object if successful, otherwise None.
     """
+    # The password hash is part of the key so a wrong or changed password never gets a cached session back
+    pool_key = (imap_server, email_user, hashlib.sha256(email_pass.encode("utf-8")).hexdigest())
+    mail = _IMAP_POOL.pop(pool_key, None)
+    if mail is not None:
+        try:
+            mail.noop()  # Keepalive check; a dropped or logged-out connection raises here
+            _IMAP_POOL[pool_key] = mail
+            return mail
+        except (imaplib.IMAP4.error, OSError):
+            pass  # Fall through and reconnect
+    
     try:
-        mail = imaplib.IMAP4_SSL(imap_server)
+        mail = imaplib.IMAP4_SSL(imap_server, ssl_context=ssl.create_default_context())
         mail.login(email_user, email_pass)
         mail.select("inbox")
-        print(f"Successfully connected to: {'Gmail' if 'gmail' in imap_server else 'Outlook'}")
+        print(f"Successfully connected to: {provider.title() if provider else imap_server}")
+        _IMAP_POOL[pool_key] = mail
         return mail
     except imaplib.IMAP4.error:
         print("Error: Authentication failed. Check email and password.")
@@ -57,10 +189,21 @@ def connect_to_email(imap_server, email_user, email_pass):
         print("Error connecting to email:", e)
         return None
 
+# Closing pooled email connections
+def close_pooled_connections():
+    """Logs out of every pooled email connection and empties the pool."""
+    while _IMAP_POOL:
+        _, mail = _IMAP_POOL.popitem()
+        try:
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass  # Connection already dropped
+
 # Searching emails based on filter
 def search_emails(mail, filter_type, filter_value):
     """
     Searches for emails based on a filter type (subject, sender, or attachments).
+    The search is combined server-side with a minimum size and, on Gmail, an attachment filter.
     
     Args:
         mail (imaplib.IMAP4_SSL): IMAP connection object.
@@ -71,28 +214,100 @@ def search_emails(mail, filter_type, filter_value):
         list: List of email UIDs matching the search criteria.
     """
     search_filters = {
-        "subject": f'(SUBJECT "{filter_value}")',
-        "sender": f'(FROM "{filter_value}")',
-        "attachments": "(X-GM-RAW \"has:attachment\")"
+        "subject": f'SUBJECT "{filter_value}"',
+        "sender": f'FROM "{filter_value}"',
+        "attachments": GMAIL_HAS_ATTACHMENT_FILTER
     }
     
     if filter_type not in search_filters:
         print("Invalid filter type!")
         return []
     
-    result, data = mail.search(None, search_filters[filter_type])
+    # Narrow the search server-side so fewer emails without invoice attachments are fetched later
+    criteria = [f"LARGER {MIN_INVOICE_EMAIL_SIZE}", search_filters[filter_type]]
+    if GMAIL_CAPABILITY in mail.capabilities and filter_type != "attachments":
+        criteria.append(GMAIL_HAS_ATTACHMENT_FILTER)
+    
+    result, data = mail.uid("SEARCH", None, f"({' '.join(criteria)})")
     if result != "OK":
         print("Error searching emails.")
         return []
     return data[0].split()
 
-# Processing email and extracting attachments
-def process_email(mail, email_uid, save_folder="Invoices"):
+# Fetching matching emails in batched IMAP round-trips
+def fetch_emails(mail, email_uids):
     """
-    Processes an email to extract metadata and download attachments.
+    Fetches the raw RFC822 content of the given emails with one UID FETCH command per batch of
+    FETCH_BATCH_SIZE UIDs, which bounds both memory use and the command length.
     
     Args:
         mail (imaplib.IMAP4_SSL): IMAP connection object.
+        email_uids (list): List of email UIDs (bytes) to fetch.
+    
+    Yields:
+        dict: Raw email bytes keyed by email UID (bytes), one dict per fetched batch.
+    """
+    for start in range(0, len(email_uids), FETCH_BATCH_SIZE):
+        batch_uids = email_uids[start:start + FETCH_BATCH_SIZE]
+        result, fetch_data = mail.uid("FETCH", b",".join(batch_uids), "(RFC822)")
+        if result != "OK":
+            print("Error fetching emails.")
+            continue
+        
+        raw_emails = {}
+        pending_email = None
+        for item in fetch_data:
+            # Message data arrives as (b'<seq> (UID <uid> RFC822 {<size>}', raw_bytes) followed by a b')' terminator;
+            # some servers send the UID after the literal instead, i.e. in the terminator (b' UID <uid>)')
+            if isinstance(item, tuple):
+                header, pending_email = item
+            else:
+                header = item
+            if pending_email is not None and (uid_match := FETCH_UID_RE.search(header)):
+                raw_emails[uid_match.group(1)] = pending_email
+                pending_email = None
+        for uid in batch_uids:
+            if uid not in raw_emails:
+                print(f"Failed to fetch email UID: {uid}")
+        yield raw_emails
+
+# Writing an attachment payload to disk
+def save_attachment(part, filepath):
+    """
+    Writes a MIME attachment to disk, streaming base64 payloads through the decoder in chunks
+    instead of materializing the whole decoded attachment in memory first.
+    
+    Args:
+        part (email.message.Message): MIME part holding the attachment.
+        filepath (str): Destination file path.
+    """
+    if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+        try:
+            with open(filepath, "wb") as f:
+                payload = part.get_payload(decode=False)
+                leftover = ""
+                for offset in range(0, len(payload), BASE64_DECODE_CHUNK_SIZE):
+                    # Lines need not hold a multiple of 4 characters, so carry any incomplete quantum over to the next chunk
+                    chunk = leftover + "".join(payload[offset:offset + BASE64_DECODE_CHUNK_SIZE].split())
+                    usable = len(chunk) - len(chunk) % 4
+                    f.write(binascii.a2b_base64(chunk[:usable]))
+                    leftover = chunk[usable:]
+                if leftover:
+                    f.write(binascii.a2b_base64(leftover))
+            return
+        except binascii.Error:
+            pass  # Malformed base64; rewrite the file below with the email package's lenient decoder
+    
+    with open(filepath, "wb") as f:
+        f.write(part.get_payload(decode=True))
+
+# Parsing email and extracting attachments
+def parse_email(raw_email, email_uid, save_folder="Invoices"):
+    """
+    Parses a fetched email to extract metadata and download attachments.
+    
+    Args:
+        raw_email (bytes): Raw RFC822 content of the email.
         email_uid (bytes): UID of the email to process.
         save_folder (str): Directory to save attachments.
     
@@ -101,80 +316,252 @@ def process_email(mail, email_uid, save_folder="Invoices"):
     """
     try:
         os.makedirs(save_folder, exist_ok=True)
-        result, email_data = mail.fetch(email_uid, "(RFC822)")
-        if result != "OK":
-            print(f"Failed to fetch email UID: {email_uid}")
-            return None
-        
-        msg = email.message_from_bytes(email_data[0][1])
-        sender = msg.get("From", "Unknown")
-        subject, encoding = decode_header(msg.get("Subject", "Unknown"))[0]
-        subject = subject.decode(encoding) if isinstance(subject, bytes) else subject
+        # The default policy decodes headers on access.
+        # Feeding the parser in chunks avoids decoding the whole raw message into one string up front.
+        parser = email.parser.BytesFeedParser(policy=email.policy.default)
+        raw_view = memoryview(raw_email)
+        for offset in range(0, len(raw_view), EMAIL_PARSE_CHUNK_SIZE):
+            parser.feed(bytes(raw_view[offset:offset + EMAIL_PARSE_CHUNK_SIZE]))
+        msg = parser.close()
+        sender = str(msg.get("From", "Unknown"))
+        subject = str(msg.get("Subject", "Unknown"))
         
         attachments = []
+        # walk() covers every nesting level: nested multiparts, forwarded message/rfc822 parts and single-part emails
         for part in msg.walk():
-            if part.get("Content-Disposition"):
-                filename = part.get_filename()
-                if filename and filename.lower().endswith((".pdf", ".jpg", ".png")):
-                    filepath = os.path.join(save_folder, filename)
-                    with open(filepath, "wb") as f:
-                        f.write(part.get_payload(decode=True))
-                    attachments.append(filepath)
+            if part.is_multipart():
+                continue
+            filename = part.get_filename()
+            if filename and filename.lower().endswith((".pdf", ".jpg", ".png")):
+                filepath = os.path.join(save_folder, filename)
+                save_attachment(part, filepath)
+                attachments.append(filepath)
 
-        return {"email_uid": str(email_uid), "sender": sender, "subject": subject, "attachments": attachments} if attachments else None
+        return {"email_uid": str(email_uid), "email_uid_type": EMAIL_UID_TYPE, "sender": sender, "subject": subject, "attachments": attachments} if attachments else None
     
     except Exception as e:
-        print(f"Error processing email UID {email_uid}: {e}")
+        print(f"Error parsing email UID {email_uid}: {e}")
         return None
 
-# Extracting text from attachments
-def extract_text_from_attachments(attachments):
-    """Extracts text from invoice attachments using OCR."""
-    extracted_texts = {}
-    for file in attachments:
-        if file.lower().endswith(".pdf"):
-            images = pdf2image.convert_from_path(file)
-            text = "\n".join([pytesseract.image_to_string(img).strip() for img in images])
-        elif file.lower().endswith((".jpg", ".png")):
-            text = pytesseract.image_to_string(Image.open(file))
-        else:
-            continue
-        extracted_texts[file] = text
-    return extracted_texts
+# Initializing the OCR engine once per worker process
+def _init_ocr_worker():
+    """Loads a persistent Tesseract API for this worker process when tesserocr is installed; the worker uses pytesseract otherwise."""
+    global _TESS_API
+    if PyTessBaseAPI is not None:
+        try:
+            _TESS_API = PyTessBaseAPI(lang="eng")
+        except RuntimeError as e:
+            # e.g. a missing or wrong tessdata path; failing here would break the whole worker pool
+            print("Warning: Unable to load tesserocr, falling back to pytesseract:", e)
+            _TESS_API = None
+
+def _tesserocr_image_to_string(image):
+    """Runs OCR on a PIL image through the worker's persistent Tesseract API."""
+    _TESS_API.SetImage(image)
+    return _TESS_API.GetUTF8Text()
+
+def _extract_pdf_text_layer(file):
+    """Returns the embedded text layer of a PDF, or an empty string if it has none or cannot be read."""
+    try:
+        return pdfminer.high_level.extract_text(file)
+    except Exception as e:
+        print(f"Error reading text layer of {file}, falling back to OCR: {e}")
+        return ""
+
+def _prepare_for_ocr(image):
+    """Converts an image to a binarized bitmap, downscaled to at most A4 at 300 DPI, to shrink Tesseract's input."""
+    image = image.convert("L")
+    longest_side = max(image.size)
+    if longest_side > MAX_OCR_IMAGE_SIDE:
+        scale = MAX_OCR_IMAGE_SIDE / longest_side
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+    return image.point(lambda p: 0 if p < OCR_BINARIZE_THRESHOLD else 255, mode="1")
+
+def _ocr_pdf(file):
+    """Rasterizes every page of a PDF and extracts its text using OCR."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Rasterize straight to TIFF files (parallelized inside pdftoppm) rather than into in-memory images
+        page_paths = pdf2image.convert_from_path(file, output_folder=tmp_dir, fmt="tiff", paths_only=True, grayscale=True, thread_count=PDF_RASTER_THREADS)
+        for page_path in page_paths:
+            with Image.open(page_path) as img:
+                prepared = _prepare_for_ocr(img)
+            prepared.save(page_path, compression="group4")
+        
+        if _TESS_API is not None:
+            return "\n".join(_tesserocr_image_to_string(Image.open(page_path)).strip() for page_path in page_paths)
+        
+        # OCR all pages with a single tesseract run over a list file, instead of starting tesseract once per page
+        list_file = os.path.join(tmp_dir, "pages.txt")
+        with open(list_file, "w") as f:
+            f.write("\n".join(os.path.abspath(page_path) for page_path in page_paths))
+        # Tesseract separates the pages of a multi-image run with form feeds
+        page_texts = pytesseract.image_to_string(list_file).split("\f")
+        return "\n".join(page_text.strip() for page_text in page_texts if page_text.strip())
+
+# Text extraction of a single attachment, run inside a worker process
+def _ocr_one(file):
+    """Extracts text from one invoice attachment and returns a (file, text) tuple, or None for unsupported files."""
+    if file.lower().endswith(".pdf"):
+        # Most generated invoice PDFs carry an embedded text layer; only rasterize and OCR when it is missing
+        text = _extract_pdf_text_layer(file)
+        if len(text.strip()) <= MIN_PDF_TEXT_LAYER_CHARS:
+            text = _ocr_pdf(file)
+    elif file.lower().endswith((".jpg", ".png")):
+        image = _prepare_for_ocr(Image.open(file))
+        text = _tesserocr_image_to_string(image) if _TESS_API is not None else pytesseract.image_to_string(image)
+    else:
+        return None
+    return file, text
+
+# Creating the OCR worker pool shared by the whole run
+def create_ocr_executor():
+    """Creates the process pool that extracts attachment text; each worker loads its OCR engine once, in _init_ocr_worker."""
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1, initializer=_init_ocr_worker)
+
+# Starting text extraction for attachments
+def submit_text_extraction(executor, attachments):
+    """
+    Queues text extraction (embedded PDF text or OCR) of invoice attachments on the OCR worker pool.
+    
+    Args:
+        executor (concurrent.futures.ProcessPoolExecutor): Pool from create_ocr_executor.
+        attachments (list): File paths of the saved attachments.
+    
+    Returns:
+        list: Futures resolving to (file, text) tuples, or None for unsupported files.
+    """
+    return [executor.submit(_ocr_one, file) for file in attachments]
+
+# Collecting extracted text from attachments
+def collect_extracted_texts(futures):
+    """
+    Waits for queued text extraction to finish.
+    
+    Args:
+        futures (list): Futures from submit_text_extraction.
+    
+    Returns:
+        dict: Extracted text (str) keyed by file path; unsupported files are left out.
+    """
+    return dict(result for future in futures if (result := future.result()) is not None)
 
 # Extracting structured invoice data
-def extract_invoice_data(text):
-    """Extracts key invoice data such as invoice number, amount, due date, and payment status from text using regular expression (re)."""
-    invoice_details = {}
-    invoice_details["invoice_number"] = re.search(r"([A-Z]{3,5}\d{6,8})", text, re.IGNORECASE).group(1) if re.search(r"([A-Z]{3,5}\d{6,8})", text, re.IGNORECASE) else "Unknown"
-    invoice_details["amount"] = re.search(r"€\s?([\d,]+\.\d{2})", text).group(1) if re.search(r"€\s?([\d,]+\.\d{2})", text) else "Unknown"
-    invoice_details["due_date"] = re.search(r"Due Date[:\s]*(\d{2}/\d{2}/\d{4})", text, re.IGNORECASE).group(1) if re.search(r"Due Date[:\s]*(\d{2}/\d{2}/\d{4})", text, re.IGNORECASE) else "Unknown"
-    invoice_details["payment_status"] = "Paid" if re.search(r"\bPaid\b", text, re.IGNORECASE) else "Unpaid"
+def extract_invoice_data(texts):
+    """
+    Extracts key invoice data such as invoice number, amount, due date, and payment status from several texts
+    using regular expression (re), scanning each text separately and stopping once every field has been found.
+    
+    Args:
+        texts (iterable): Texts to scan in order, e.g. one per attachment (a single text must be wrapped in a list).
+    
+    Returns:
+        dict: Extracted invoice details, keeping the first match found for each field (invoice numbers are upper-cased);
+        fields that are not found are None.
+    """
+    invoice_details = {"invoice_number": None, "amount": None, "due_date": None, "payment_status": "Unpaid"}
+    found = set()
+    for text in texts:
+        # Upper-casing once is cheaper than case folding every comparison during the scan
+        for m in INVOICE_FIELDS_RE.finditer(text.upper()):
+            field = m.lastgroup
+            if field in found:
+                continue  # Keep the first match for each field
+            found.add(field)
+            invoice_details[field] = "Paid" if field == "payment_status" else m.group(field)
+            if len(found) == len(invoice_details):
+                return invoice_details
     return invoice_details
 
+# Parsing numeric fields of all extracted invoices at once
+def add_parsed_fields(extracted_invoices):
+    """
+    Adds numeric amount and datetime due date fields to all invoices using vectorized pandas parsing,
+    instead of converting each invoice's strings one by one.
+    
+    Args:
+        extracted_invoices (list): Extracted invoice data dicts.
+    
+    Returns:
+        list: Invoice data dicts with "amount_value" (float) and "due_date_parsed" (datetime) added;
+        either is None when the extracted value is missing or cannot be parsed.
+    """
+    if not extracted_invoices:
+        return extracted_invoices
+    
+    df = pd.DataFrame(extracted_invoices)
+    df["amount_value"] = pd.to_numeric(df["amount"].str.replace(",", "", regex=False), errors="coerce")
+    df["due_date_parsed"] = pd.to_datetime(df["due_date"], format="%d/%m/%Y", errors="coerce")
+    # NaN/NaT cannot be stored meaningfully in MongoDB, so missing values become None
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict("records")
+
 # Storing extracted data in MongoDB and printing structured JSON output
-def store_in_mongo(collection, recurring_collection, extracted_data):
-    """Stores invoice data in MongoDB"""
-    if collection.find_one({"email_uid": extracted_data["email_uid"], "sender": extracted_data["sender"], "invoice_number": extracted_data["invoice_number"]}):
-        print("Duplicate invoice detected. Skipping storage.")
+def store_in_mongo(collection, recurring_collection, extracted_invoices):
+    """
+    Stores a batch of invoice data in MongoDB, skipping duplicates and routing recurring invoices separately.
+    
+    Existing duplicates and sender/amount pairs are looked up with a single query, and each collection
+    is then written with a single bulk_write, instead of two lookups and one insert per invoice.
+    Invoices with an unknown (None) amount or due date are never classified as recurring.
+    Older records keyed by sequence number instead of UID count as duplicates when sender and invoice number match.
+    
+    Args:
+        collection (pymongo.collection.Collection): Collection for regular invoices.
+        recurring_collection (pymongo.collection.Collection): Collection for recurring invoices.
+        extracted_invoices (list): Extracted invoice data dicts to store.
+    """
+    if not extracted_invoices:
         return
     
-    if collection.find_one({"sender": extracted_data["sender"], "amount": extracted_data["amount"]}) and extracted_data["due_date"] != "Unknown":
-        recurring_collection.insert_one(extracted_data)
-        print("Stored in RecurringInvoices.")
-    else:
-        collection.insert_one(extracted_data)
-        print("Stored in Invoices.")
+    dedup_keys = [{field: invoice[field] for field in DEDUP_KEY_FIELDS} for invoice in extracted_invoices]
+    recurring_keys = [{field: invoice[field] for field in RECURRING_KEY_FIELDS} for invoice in extracted_invoices if invoice["amount"] is not None]
+    legacy_keys = [
+        {**{field: invoice[field] for field in LEGACY_DEDUP_KEY_FIELDS}, "email_uid_type": {"$exists": False}}
+        for invoice in extracted_invoices if invoice["invoice_number"] is not None
+    ]
+    projection = {field: 1 for field in DEDUP_KEY_FIELDS + RECURRING_KEY_FIELDS + ["email_uid_type"]}
+    stored_dedup_keys, stored_legacy_keys, stored_recurring_keys = set(), set(), set()
+    for doc in collection.find({"$or": dedup_keys + legacy_keys + recurring_keys}, projection):
+        stored_dedup_keys.add(tuple(doc.get(field) for field in DEDUP_KEY_FIELDS))
+        stored_recurring_keys.add(tuple(doc.get(field) for field in RECURRING_KEY_FIELDS))
+        if "email_uid_type" not in doc and doc.get("invoice_number") is not None:
+            stored_legacy_keys.add(tuple(doc.get(field) for field in LEGACY_DEDUP_KEY_FIELDS))
+    
+    invoice_ops, recurring_ops = [], []
+    for invoice, dedup_key in zip(extracted_invoices, dedup_keys):
+        dedup_tuple = tuple(dedup_key.values())
+        recurring_tuple = tuple(invoice[field] for field in RECURRING_KEY_FIELDS)
+        legacy_tuple = tuple(invoice[field] for field in LEGACY_DEDUP_KEY_FIELDS)
+        if dedup_tuple in stored_dedup_keys or legacy_tuple in stored_legacy_keys:
+            print("Duplicate invoice detected. Skipping storage.")
+            continue
+        
+        if invoice["amount"] is not None and invoice["due_date"] is not None and recurring_tuple in stored_recurring_keys:
+            recurring_ops.append(InsertOne(invoice))
+            print("Stored in RecurringInvoices.")
+        else:
+            # Upserting on the unique dedup key keeps the write idempotent if the same invoice is stored concurrently
+            invoice_doc = {field: value for field, value in invoice.items() if field not in dedup_key}
+            invoice_ops.append(UpdateOne(dedup_key, {"$setOnInsert": invoice_doc}, upsert=True))
+            stored_dedup_keys.add(dedup_tuple)
+            stored_recurring_keys.add(recurring_tuple)
+            print("Stored in Invoices.")
+    
+    if invoice_ops:
+        collection.bulk_write(invoice_ops, ordered=False)
+    if recurring_ops:
+        recurring_collection.bulk_write(recurring_ops, ordered=False)
 
 # Main Execution
 def main():
-    imap_server = "imap.gmail.com" if "gmail" in input("Enter IMAP Server (Gmail/Outlook): ").lower() else "outlook.office365.com"
+    provider = input("Enter IMAP Server (Gmail/Outlook/Yahoo or server address): ").strip().lower()
+    imap_server = IMAP_SERVERS.get(provider, provider)
     email_user = input("Enter Email Address: ")
     email_pass = input("Enter Email Password: ")
     filter_type = input("Search by (subject/sender/attachments): ")
     filter_value = input("Enter Filter Value: ") if filter_type != "attachments" else ""
     
-    mail = connect_to_email(imap_server, email_user, email_pass)
+    mail = connect_to_email(imap_server, email_user, email_pass, provider if provider in IMAP_SERVERS else None)
     if not mail:
         return
     
@@ -185,21 +572,37 @@ def main():
     email_uids = search_emails(mail, filter_type, filter_value)
     extracted_invoices = []
     
-    for uid in email_uids:
-        email_data = process_email(mail, uid)
-        if not email_data:
-            continue
-        
-        extracted_texts = extract_text_from_attachments(email_data["attachments"])
-        invoice_details = extract_invoice_data(" ".join([text.decode('utf-8', 'ignore') if isinstance(text, bytes) else text for text in extracted_texts.values()]))
-        email_data.update(invoice_details)
-        store_in_mongo(collection, recurring_collection, email_data)
-        extracted_invoices.append(email_data)
-
+    # One OCR pool for the whole run, so workers and their OCR engines are started only once
+    with create_ocr_executor() as ocr_executor:
+        # Only one batch of raw emails is held in memory at a time
+        for raw_emails in fetch_emails(mail, email_uids):
+            # Queue the attachments of every email in the batch first, so they are extracted in parallel across emails
+            pending_emails = []
+            for uid in list(raw_emails):
+                email_data = parse_email(raw_emails.pop(uid), uid)  # Popped so each raw message is freed once parsed
+                if email_data:
+                    pending_emails.append((email_data, submit_text_extraction(ocr_executor, email_data["attachments"])))
+            
+            batch_invoices = []
+            for email_data, futures in pending_emails:
+                try:
+                    extracted_texts = collect_extracted_texts(futures)
+                except Exception as e:
+                    # A corrupt or unreadable attachment skips only its own email
+                    print(f"Error extracting text from email UID {email_data['email_uid']}: {e}")
+                    continue
+                invoice_details = extract_invoice_data(extracted_texts.values())
+                email_data.update(invoice_details)
+                batch_invoices.append(email_data)
+            
+            # Store each batch as soon as it is extracted, so a later failure cannot lose it
+            batch_invoices = add_parsed_fields(batch_invoices)
+            store_in_mongo(collection, recurring_collection, batch_invoices)
+            extracted_invoices.extend(batch_invoices)
 
     # printing the final structured JSON output.
     print(f"Extracted ALL Invoice Data: {json.dumps(extracted_invoices, default=str, indent=4)}")
-    mail.logout()
+    close_pooled_connections()
     print("************Successfully extracted and stored invoice data from your email. Thank You!************")
 
 if __name__ == "__main__":